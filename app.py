@@ -1,33 +1,64 @@
+import asyncio
+import json
 import logging
 import os
+import re
+import secrets
+import threading
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Optional
+from urllib.parse import unquote
+import aiofiles
 from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from fastapi import UploadFile, File
-from split_and_transcribe import split_and_transcribe
+from split_and_transcribe import get_whisper_model, split_and_transcribe
 from pathlib import Path
 
 # импортируем нашу функцию
-from portfolio_generator import generate_portfolio
+from portfolio_generator import build_prompt, finalize_portfolio, generate_fragment, generate_portfolio, get_llm, render_pdf
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 
-app = FastAPI()
+# модель можно выбрать "small", "base" и т.д.
+WHISPER_MODEL = "small"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Прогреваем модели и WeasyPrint до первого запроса, а не во время него
+    logging.info("Прогрев моделей и WeasyPrint")
+    for warmup, *args in ((get_llm,), (get_whisper_model, WHISPER_MODEL), (render_pdf, "<p>x</p>")):
+        try:
+            await run_in_threadpool(warmup, *args)
+        except Exception:
+            # не падаем: всё догрузится лениво при первом запросе
+            logging.exception("Не удалось выполнить прогрев %s при старте", warmup.__name__)
+    yield
+
+# orjson заметно быстрее stdlib json на больших строках (HTML, транскрипт)
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 @app.get("/portfolio", response_class=FileResponse)
 async def serve_portfolio_page():
     return FileResponse(os.path.join(STATIC_DIR, "portfolio_view.html"))
 
 
-# CORS
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# CORS: фронтенд раздаётся этим же приложением, поэтому middleware подключаем
+# только для явно перечисленных сторонних источников, например
+# CORS_ORIGINS="https://portfolio.example.com,https://admin.example.com"
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "").split(",") if o.strip()]
+if CORS_ORIGINS:
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=CORS_ORIGINS,
+        allow_credentials=False,
+        allow_methods=["GET", "POST"],
+        allow_headers=["Content-Type", "Content-Disposition"],
+    )
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 STATIC_DIR = os.path.join(BASE_DIR, "static")
@@ -39,6 +70,28 @@ async def serve_index():
 
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 
+_FILENAME_RE = re.compile(r"""filename\*?=(?:UTF-8'')?"?([^";]+)"?""", re.IGNORECASE)
+
+# Готовые PDF держим в памяти процесса: у каждого запроса своя ссылка.
+# Кэш локален для процесса, поэтому uvicorn нужно запускать с одним воркером
+PDF_CACHE_SIZE = 64
+_PDF_CACHE: OrderedDict[str, bytes] = OrderedDict()
+
+def _cache_pdf(request: Request, pdf_bytes: bytes) -> Optional[str]:
+    """Кладёт PDF в LRU-кэш и возвращает ссылку, по которой он раздаётся (None, если PDF не собрался)."""
+    if not pdf_bytes:
+        return None
+    pdf_id = secrets.token_urlsafe(12)
+    _PDF_CACHE[pdf_id] = pdf_bytes
+    if len(_PDF_CACHE) > PDF_CACHE_SIZE:
+        _PDF_CACHE.popitem(last=False)
+    return str(request.url_for("get_pdf", pdf_id=pdf_id))
+
+def _sse(data: dict, event: Optional[str] = None) -> str:
+    """Форматирует одно событие Server-Sent Events."""
+    message = f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+    return f"event: {event}\n{message}" if event else message
+
 class TextRequest(BaseModel):
     text: str
 
@@ -50,36 +103,104 @@ async def health():
 async def api_generate(req: TextRequest, request: Request):
     logging.info("Генерация портфолио через модуль")
     try:
-        html_content, pdf_bytes = generate_portfolio(req.text)
+        # LLM и WeasyPrint блокируют поток — уводим их с event loop
+        html_content, pdf_bytes = await run_in_threadpool(generate_portfolio, req.text)
     except Exception as e:
         logging.exception("Ошибка генерации")
         raise HTTPException(status_code=500, detail=str(e))
 
-    # Сохраняем на диск, чтобы PDF раздавался статически
-    html_path = os.path.join(BASE_DIR, "portfolio.html")
-    pdf_path = os.path.join(STATIC_DIR, "portfolio.pdf")
-    with open(html_path, "w", encoding="utf-8") as f:
-        f.write(html_content)
-    with open(pdf_path, "wb") as f:
-        f.write(pdf_bytes)
-
     # Возвращаем HTML-фрагмент и ссылку на PDF
-    pdf_url = request.url_for("static", path="portfolio.pdf")
+    pdf_url = _cache_pdf(request, pdf_bytes)
     return {"html": html_content, "pdf_url": pdf_url}
 
+@app.get("/api/portfolio/pdf/{pdf_id}")
+async def get_pdf(pdf_id: str):
+    pdf_bytes = _PDF_CACHE.get(pdf_id)
+    if pdf_bytes is None:
+        raise HTTPException(status_code=404, detail="PDF не найден или уже вытеснен из кэша")
+    _PDF_CACHE.move_to_end(pdf_id)
+    return Response(
+        pdf_bytes,
+        media_type="application/pdf",
+        headers={"Content-Disposition": 'inline; filename="portfolio.pdf"'},
+    )
+
+@app.post("/api/portfolio/stream")
+async def api_generate_stream(req: TextRequest, request: Request):
+    """Отдаёт HTML-фрагмент по мере генерации (SSE), в конце — итоговый HTML и ссылку на PDF."""
+    logging.info("Потоковая генерация портфолио через модуль")
+    try:
+        prompt = build_prompt(req.text)
+    except Exception as e:
+        logging.exception("Ошибка генерации")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def event_gen():
+        loop = asyncio.get_running_loop()
+        deltas: asyncio.Queue = asyncio.Queue()
+        stop_event = threading.Event()
+
+        def on_delta(delta: str) -> None:
+            loop.call_soon_threadsafe(deltas.put_nowait, delta)
+
+        # Вся генерация — один вызов в пуле потоков: модель занята ровно столько,
+        # сколько идёт инференс, а медленный клиент лишь копит токены в очереди
+        job = asyncio.ensure_future(run_in_threadpool(generate_fragment, prompt, on_delta, stop_event))
+        job.add_done_callback(lambda _: deltas.put_nowait(None))
+        try:
+            while (delta := await deltas.get()) is not None:
+                yield _sse({"delta": delta})
+            html_content, pdf_bytes = await run_in_threadpool(finalize_portfolio, job.result())
+            pdf_url = _cache_pdf(request, pdf_bytes)
+        except Exception as e:
+            logging.exception("Ошибка генерации")
+            yield _sse({"detail": str(e)}, event="error")
+            return
+        finally:
+            # клиент отключился посреди генерации — останавливаем её на следующем токене
+            stop_event.set()
+            job.add_done_callback(lambda f: f.cancelled() or f.exception())
+        yield _sse({"html": html_content, "pdf_url": pdf_url}, event="done")
+
+    return StreamingResponse(
+        event_gen(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def _upload_filename(request: Request, filename: Optional[str]) -> str:
+    """Имя файла из query-параметра или заголовка Content-Disposition."""
+    if not filename:
+        match = _FILENAME_RE.search(request.headers.get("content-disposition", ""))
+        filename = unquote(match.group(1)) if match else None
+    # отбрасываем каталоги, чтобы нельзя было писать за пределы uploads/
+    name = Path(filename or "").name
+    if name in ("", ".", ".."):
+        raise HTTPException(status_code=400, detail="Не указано имя файла (параметр filename или Content-Disposition)")
+    return name
+
 @app.post("/api/transcribe")
-async def api_transcribe(file: UploadFile = File(...)):
-    # сохраняем загруженный аудиофайл
+async def api_transcribe(request: Request, filename: Optional[str] = None):
+    # тело запроса — сам файл; multipart-конверт целиком ушёл бы в "аудио"
+    if request.headers.get("content-type", "").lower().startswith("multipart/"):
+        raise HTTPException(status_code=415, detail="Файл передаётся телом запроса, multipart/form-data не поддерживается")
+
+    # сохраняем загруженный аудиофайл потоково, не держа его целиком в памяти
     uploads = Path("uploads")
     uploads.mkdir(exist_ok=True)
-    input_path = uploads / file.filename
-    with open(input_path, "wb") as f:
-        f.write(await file.read())
+    input_path = uploads / _upload_filename(request, filename)
+    try:
+        async with aiofiles.open(input_path, "wb") as f:
+            async for chunk in request.stream():
+                await f.write(chunk)
+    except BaseException:
+        # клиент отключился или запись упала — недокачанный файл не оставляем
+        input_path.unlink(missing_ok=True)
+        raise
 
     # вызываем ваш скрипт split_and_transcribe
-    # модель можно выбрать "small", "base" и т.д.
-    transcript_path = split_and_transcribe(input_path, model="small", language="Russian")
+    transcript_path = await run_in_threadpool(split_and_transcribe, input_path, model=WHISPER_MODEL, language="ru")
 
     # читаем полученный файл
-    text = transcript_path.read_text(encoding="utf-8")
+    text = await run_in_threadpool(transcript_path.read_text, encoding="utf-8")
     return {"text": text}
\ No newline at end of file
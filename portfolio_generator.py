@@ -1,55 +1,109 @@
 import os
+import re
 import logging
-from typing import Tuple
+import threading
+from typing import Callable, Optional, Tuple
 from huggingface_hub import hf_hub_download
-from llama_cpp import Llama
-from weasyprint import HTML
-from bs4 import BeautifulSoup
+from llama_cpp import GGML_TYPE_Q8_0, Llama
+from weasyprint import CSS, HTML
+from lxml import html as lxml_html
 
 # Настройки
-MODEL_REPO     = "TheBloke/Qwen2-7B-Instruct-GGUF"
-MODEL_FILENAME = "Qwen2.5-7B-Instruct.Q4_K_M.gguf"
-MODEL_DIR      = "models"
+# Q4_0 llama.cpp при загрузке перепаковывает в Q4_0_8_8 / Q4_0_4_8 и считает
+# через int8-инструкции (i8mm на ARM, AVX512-VNNI на x86). Для этого
+# llama-cpp-python нужно собрать с CMAKE_ARGS="-DGGML_NATIVE=ON -DGGML_CPU_AARCH64=ON".
+# Для шаблонного HTML по уже структурированному тексту хватает 3B-модели.
+MODEL_REPO     = "Qwen/Qwen2.5-3B-Instruct-GGUF"
+MODEL_FILENAME = "qwen2.5-3b-instruct-q4_0.gguf"
 PROMPT_TEMPLATE = "prompt_template.txt"
 LAYOUT_TEMPLATE = "layout.html"
 
+# Параметры генерации, общие для обычного и потокового режима.
+# Фрагмент не должен содержать <body>/<html>: если модель начала дописывать
+# обёртку страницы, полезный HTML уже закончился и дальше декодировать незачем.
+GENERATION_PARAMS = {
+    "max_tokens": 1200,
+    "temperature": 0.3,
+    "top_p": 0.9,
+    "repeat_penalty": 1.05,
+    "stop": ["</body>", "</html>"],
+}
+
+_FENCE_RE = re.compile(r"```(?:html)?")
+_STYLE_RE = re.compile(r"<style[^>]*>(.*?)</style>", re.DOTALL | re.IGNORECASE)
+
+# Модель загружается один раз на процесс и переиспользуется между запросами
+_LLM: Optional[Llama] = None
+_LLM_LOCK = threading.Lock()
+# Контекст llama.cpp не потокобезопасен: генерации идут по очереди
+_LLM_GEN_LOCK = threading.Lock()
+
 def sanitize_html(raw_html: str) -> str:
     """Удаляет markdown-обёртки и избыточные ```."""
-    soup = BeautifulSoup(raw_html, "html.parser")
-    for tag in soup(text=lambda t: isinstance(t, str) and "```" in t):
-        tag.replace_with(tag.replace("```html", "").replace("```", ""))
-    return str(soup)
+    return _FENCE_RE.sub("", raw_html)
 
 def deduplicate_sections(html: str) -> str:
     """Убирает повторяющиеся <section> по заголовкам."""
-    soup = BeautifulSoup(html, "html.parser")
+    root = lxml_html.fragment_fromstring(html, create_parent="div")
     seen = set()
-    for section in soup.find_all("section"):
-        h2 = section.find("h2")
-        if h2:
-            title = h2.text.strip()
+    for section in list(root.iter("section")):
+        h2 = section.find(".//h2")
+        if h2 is not None:
+            title = h2.text_content().strip()
             if title in seen:
-                section.decompose()
+                section.drop_tree()
             else:
                 seen.add(title)
-    return str(soup)
+    # Обёртку-div не возвращаем, только её содержимое
+    return (root.text or "") + "".join(lxml_html.tostring(child, encoding="unicode") for child in root)
 
 def download_model() -> str:
-    """Скачивает модель из Hugging Face, если её нет локально."""
-    os.makedirs(MODEL_DIR, exist_ok=True)
-    path = os.path.join(MODEL_DIR, MODEL_FILENAME)
-    if not os.path.isfile(path):
-        logging.info("Скачивание модели из репозитория %s (%s)...", MODEL_REPO, MODEL_FILENAME)
-        try:
-            path = hf_hub_download(repo_id=MODEL_REPO, filename=MODEL_FILENAME, local_dir=MODEL_DIR)
-            logging.info("Модель скачана и сохранена по пути: %s", path)
-        except Exception as e:
-            logging.exception("Не удалось загрузить модель: %s", e)
-            raise
-    else:
-        logging.info("Модель найдена локально: %s", path)
+    """Возвращает путь к модели в кэше Hugging Face, скачивая её при первом обращении."""
+    logging.info("Получение модели из репозитория %s (%s)...", MODEL_REPO, MODEL_FILENAME)
+    try:
+        # При попадании в кэш (~/.cache/huggingface/hub) файл не скачивается заново
+        path = hf_hub_download(repo_id=MODEL_REPO, filename=MODEL_FILENAME)
+    except Exception as e:
+        logging.exception("Не удалось загрузить модель: %s", e)
+        raise
+    logging.info("Модель доступна по пути: %s", path)
     return path
 
+def get_llm() -> Llama:
+    """Возвращает общий экземпляр модели, инициализируя его при первом вызове."""
+    global _LLM
+    if _LLM is not None:
+        return _LLM
+    with _LLM_LOCK:
+        if _LLM is None:
+            model_path = download_model()
+            logging.info("Инициализация модели LLaMA из файла %s", model_path)
+            try:
+                _LLM = Llama(
+                    model_path=model_path,
+                    n_ctx=8192,
+                    # Префилл длинного промта — крупными батчами на всех ядрах
+                    n_batch=2048,
+                    n_ubatch=512,
+                    n_threads=os.cpu_count() or 4,
+                    n_threads_batch=os.cpu_count() or 4,
+                    # Логиты нужны только для последнего токена, эмбеддинги не нужны
+                    logits_all=False,
+                    embedding=False,
+                    offload_kqv=True,
+                    # KV-кэш в Q8_0 вдвое легче FP16; квантованный V требует flash_attn
+                    flash_attn=True,
+                    type_k=GGML_TYPE_Q8_0,
+                    type_v=GGML_TYPE_Q8_0,
+                    use_mmap=True,
+                    use_mlock=False,
+                    verbose=False
+                )
+            except Exception as e:
+                logging.exception("Ошибка при загрузке модели: %s", e)
+                raise
+    return _LLM
+
 def load_text(path: str, desc: str) -> str:
     """Загружает текстовый файл, бросает IOError если нет."""
     if not os.path.isfile(path):
@@ -57,23 +111,8 @@ def load_text(path: str, desc: str) -> str:
     with open(path, "r", encoding="utf-8") as f:
         return f.read()
 
-def generate_portfolio(presentation: str) -> Tuple[str, bytes]:
-    """
-    Генерирует HTML и PDF по тексту самопрезентации.
-    :param presentation: текст (уже структурированный по разделам [О себе], [Навыки], ...)
-    :return: (full_html, pdf_bytes)
-    """
-    # Простая проверка входных данных
-    if not presentation or not presentation.strip():
-        logging.error("Текст самопрезентации отсутствует или пуст")
-        raise ValueError("Текст самопрезентации отсутствует или пуст")
-
-    # Шаблоны
-    prompt_tpl = load_text(PROMPT_TEMPLATE, "шаблон промта")
-    layout_tpl = load_text(LAYOUT_TEMPLATE, "шаблон веб-страницы")
-    logging.info("Шаблоны загружены (промт и layout)")
-
-    # Готовим текст промта для модели (используем только шаг генерации HTML)
+def _trim_step2(prompt_tpl: str) -> str:
+    """Оставляет в шаблоне промта только шаг генерации HTML."""
     # Удаляем часть с шагом 1, так как входной текст уже структурирован
     step2_idx = prompt_tpl.find("Шаг 2")
     if step2_idx != -1:
@@ -81,32 +120,90 @@ def generate_portfolio(presentation: str) -> Tuple[str, bytes]:
         newline_idx = prompt_tpl.find("\n")
         if newline_idx != -1:
             prompt_tpl = prompt_tpl[newline_idx+1:]
+    return prompt_tpl
+
+# Шаблоны статичны — читаем их один раз при импорте модуля
+_PROMPT_TPL = _trim_step2(load_text(PROMPT_TEMPLATE, "шаблон промта"))
+_LAYOUT_TPL = load_text(LAYOUT_TEMPLATE, "шаблон веб-страницы")
+
+def build_prompt(presentation: str) -> str:
+    """Проверяет текст самопрезентации и подставляет его в шаблон промта."""
+    # Простая проверка входных данных
+    if not presentation or not presentation.strip():
+        logging.error("Текст самопрезентации отсутствует или пуст")
+        raise ValueError("Текст самопрезентации отсутствует или пуст")
+
     # Подставляем текст презентации в шаблон
-    prompt = prompt_tpl.replace("{self_presentation}", presentation)
+    prompt = _PROMPT_TPL.replace("{self_presentation}", presentation)
     logging.info("Финальный промт для генерации HTML сформирован (длина %d символов)", len(prompt))
+    return prompt
 
-    # Загружаем и инициализируем модель
-    model_path = download_model()
-    logging.info("Инициализация модели LLaMA из файла %s", model_path)
-    try:
-        llm = Llama(
-            model_path=model_path,
-            n_ctx=8192,
-            n_threads=os.cpu_count() or 4,
-            verbose=False
-        )
-    except Exception as e:
-        logging.exception("Ошибка при загрузке модели: %s", e)
-        raise
+def generate_fragment(
+    prompt: str,
+    on_delta: Optional[Callable[[str], None]] = None,
+    stop_event: Optional[threading.Event] = None,
+) -> str:
+    """
+    Генерирует HTML-фрагмент по промту и возвращает его целиком.
+    :param on_delta: вызывается с каждым новым куском текста по мере генерации
+    :param stop_event: если установлен, генерация прерывается на следующем токене
+    """
+    # Берём закэшированную модель (загружается при первом запросе)
+    llm = get_llm()
 
-    # Генерируем HTML-фрагмент
     logging.info("Начало генерации HTML-фрагмента портфолио")
+    parts = []
+    # reset() не вызываем: llama-cpp сам переиспользует совпадающий префикс в KV-кэше,
+    # и неизменная часть шаблона до {self_presentation} не пересчитывается.
+    # Блокировка держится только внутри этого вызова, а не между отдачей токенов клиенту
+    with _LLM_GEN_LOCK:
+        # клиент мог уйти, пока ждал блокировку: первый шаг потока — это весь префилл
+        if stop_event is not None and stop_event.is_set():
+            logging.info("Генерация отменена: клиент отключился до её начала")
+            return ""
+        completion = llm(prompt, stream=True, **GENERATION_PARAMS)
+        try:
+            for chunk in completion:
+                if stop_event is not None and stop_event.is_set():
+                    logging.info("Генерация прервана: клиент отключился")
+                    break
+                delta = chunk["choices"][0]["text"]
+                parts.append(delta)
+                if on_delta is not None:
+                    on_delta(delta)
+        except Exception as e:
+            logging.exception("Ошибка при генерации текста модели: %s", e)
+            raise
+        finally:
+            completion.close()
+    return "".join(parts)
+
+def render_pdf(full_html: str) -> bytes:
+    """Генерирует PDF в память; при ошибке возвращает пустые байты."""
     try:
-        resp = llm(prompt, max_tokens=1500, temperature=0.3)
+        # Стили layout уже разобраны в _LAYOUT_CSS, inline-копию WeasyPrint не парсит
+        pdf = HTML(string=_STYLE_RE.sub("", full_html, count=1), base_url=os.getcwd())
+        pdf_bytes = pdf.write_pdf(stylesheets=[_LAYOUT_CSS])
+        logging.info("PDF успешно сгенерирован (%d байт)", len(pdf_bytes))
+        return pdf_bytes
     except Exception as e:
-        logging.exception("Ошибка при генерации текста модели: %s", e)
-        raise
-    generated = resp["choices"][0]["text"].strip()
+        logging.error("Ошибка при генерации PDF: %s", e)
+        return b""
+
+def _load_layout_css() -> CSS:
+    """Разбирает <style> из шаблона страницы в готовый CSS WeasyPrint."""
+    match = _STYLE_RE.search(_LAYOUT_TPL)
+    return CSS(string=match.group(1) if match else "")
+
+_LAYOUT_CSS = _load_layout_css()
+
+def finalize_portfolio(generated: str) -> Tuple[str, bytes]:
+    """
+    Проверяет ответ модели, чистит HTML, вставляет его в шаблон и генерирует PDF.
+    :param generated: сырой текст, который вернула модель
+    :return: (full_html, pdf_bytes)
+    """
+    generated = generated.strip()
     logging.info("Модель вернула ответ (%d символов)", len(generated))
 
     # Проверяем, не вернула ли модель JSON с уточняющими вопросами
@@ -124,18 +221,20 @@ def generate_portfolio(presentation: str) -> Tuple[str, bytes]:
     # Чистим HTML и убираем дубликаты секций
     clean_html = sanitize_html(generated)
     deduped_html = deduplicate_sections(clean_html)
-    full_html = layout_tpl.replace("{{content}}", deduped_html)
+    full_html = _LAYOUT_TPL.replace("{{content}}", deduped_html)
     logging.info("HTML-фрагмент очищен от лишних конструкций и вставлен в шаблон")
 
-    # Генерируем PDF в память
-    pdf_bytes = b""
-    try:
-        pdf = HTML(string=full_html, base_url=os.getcwd())
-        pdf_bytes = pdf.write_pdf()
-        logging.info("PDF успешно сгенерирован (%d байт)", len(pdf_bytes))
-    except Exception as e:
-        logging.error("Ошибка при генерации PDF: %s", e)
-        pdf_bytes = b""
+    pdf_bytes = render_pdf(full_html)
 
     logging.info("Генерация портфолио завершена")
     return full_html, pdf_bytes
+
+def generate_portfolio(presentation: str) -> Tuple[str, bytes]:
+    """
+    Генерирует HTML и PDF по тексту самопрезентации.
+    :param presentation: текст (уже структурированный по разделам [О себе], [Навыки], ...)
+    :return: (full_html, pdf_bytes)
+    """
+    prompt = build_prompt(presentation)
+    generated = generate_fragment(prompt)
+    return finalize_portfolio(generated)
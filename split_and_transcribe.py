@@ -1,71 +1,130 @@
 # split_and_transcribe.py
 
 from pathlib import Path
-import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+import os
 import subprocess
-from pydub import AudioSegment
+import tempfile
+import threading
+import numpy as np
+from faster_whisper import WhisperModel
 
-CHUNKS_DIR = Path("chunks")
 OUTPUT_DIR = Path("output")
-SEGMENT_MS = 10 * 60 * 1000  # 10 минут
+SEGMENT_S = 10 * 60          # 10 минут
+SAMPLE_RATE = 16000          # родная частота Whisper
+# CTranslate2 отпускает GIL, поэтому куски можно распознавать параллельно
+MAX_WORKERS = min(4, max(1, (os.cpu_count() or 2) // 2))
 
-def transcribe_chunk(chunk_path: Path, model: str, lang: str) -> Path:
+# Модели Whisper загружаются один раз на процесс и переиспользуются
+_WHISPER_MODELS: dict[str, WhisperModel] = {}
+_WHISPER_LOCK = threading.Lock()
 
+def get_whisper_model(model: str) -> WhisperModel:
+    """Возвращает закэшированную модель faster-whisper (int8 на CPU)."""
+    with _WHISPER_LOCK:
+        whisper = _WHISPER_MODELS.get(model)
+        if whisper is None:
+            # num_workers позволяет модели обслуживать вызовы из нескольких потоков одновременно,
+            # ядра делим между ними, чтобы параллельные куски не конкурировали за CPU
+            whisper = WhisperModel(
+                model,
+                device="cpu",
+                compute_type="int8",
+                cpu_threads=max(1, (os.cpu_count() or 1) // MAX_WORKERS),
+                num_workers=MAX_WORKERS,
+            )
+            _WHISPER_MODELS[model] = whisper
+        return whisper
+
+def iter_chunks(file_path: Path) -> Iterator[np.ndarray]:
+    """
+    Декодирует файл одним процессом ffmpeg в 16 кГц моно и отдаёт его
+    10‑минутными кусками float32 [-1, 1], как ждёт Whisper.
+    Длительность заранее не нужна, а вход читается один раз без перемоток.
+    """
     cmd = [
-        sys.executable, "-m", "whisper", str(chunk_path),
-        "--language", lang,
-        "--model", model,
-        "--output_format", "txt",
-        "--output_dir", str(CHUNKS_DIR),
-        "--device", "cpu"
+        "ffmpeg", "-nostdin", "-v", "error",
+        "-i", str(file_path),
+        "-ac", "1", "-ar", str(SAMPLE_RATE),
+        "-f", "s16le", "pipe:1"
     ]
-    try:
-        subprocess.run(cmd, capture_output=True, text=True, check=True)
-    except subprocess.CalledProcessError as err:
-        print(f"[!] Whisper failed on chunk {chunk_path.name}")
-        print("=== stdout ===")
-        print(err.stdout)
-        print("=== stderr ===")
-        print(err.stderr)
-        raise
-    return CHUNKS_DIR / f"{chunk_path.stem}.txt"
+    block_size = SEGMENT_S * SAMPLE_RATE * 2  # s16le: 2 байта на сэмпл
+    # stderr во временный файл, а не в PIPE: на битом входе ffmpeg пишет строку на
+    # каждый кадр и, забив буфер пайпа, встал бы, пока мы ждём его stdout
+    with tempfile.TemporaryFile() as err_f:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err_f)
+        try:
+            while pcm := proc.stdout.read(block_size):
+                yield np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+            if proc.wait() != 0:
+                err_f.seek(0)
+                stderr = err_f.read()
+                print(f"[!] ffmpeg failed on {file_path.name}")
+                print("=== stderr ===")
+                print(stderr.decode(errors="replace"))
+                raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr)
+        finally:
+            # генератор могли закрыть досрочно (ошибка распознавания) — не оставляем ffmpeg висеть
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+            proc.stdout.close()
 
-def split_and_transcribe(file_path: Path, model: str, language: str = "Russian") -> Path:
+def transcribe_chunk(whisper: WhisperModel, audio: np.ndarray, lang: str) -> str:
+    if audio.size == 0:
+        return ""
+    # куски независимы, а без опоры на предыдущий текст декодер реже зацикливается
+    segments, _ = whisper.transcribe(
+        audio,
+        language=lang,
+        beam_size=1,
+        vad_filter=True,
+        condition_on_previous_text=False,
+    )
+    return "".join(seg.text for seg in segments)
+
+def split_and_transcribe(file_path: Path, model: str, language: str = "ru") -> Path:
     """
-    Разбивает file_path на 10‑минутные куски, транскрибирует каждый через Whisper,
-    удаляет все промежуточные файлы (mp3 и .txt) и исходник, возвращая итоговый full.txt.
+    Разбивает file_path на 10‑минутные куски, транскрибирует каждый через Whisper
+    в текущем процессе, удаляет исходник и возвращает итоговый full.txt.
     """
-    CHUNKS_DIR.mkdir(exist_ok=True)
     OUTPUT_DIR.mkdir(exist_ok=True)
 
     base = file_path.stem
     full_txt = OUTPUT_DIR / f"{base}_full.txt"
-    full_txt.unlink(missing_ok=True)
 
     try:
-        audio = AudioSegment.from_file(str(file_path))
-        for i, start in enumerate(range(0, len(audio), SEGMENT_MS), start=1):
-            chunk_path = CHUNKS_DIR / f"{base}_part{i}.mp3"
-            part_txt   = CHUNKS_DIR / f"{base}_part{i}.txt"
-
-            # создаём mp3‑кусок
-            audio[start:start + SEGMENT_MS].export(str(chunk_path), format="mp3")
-            print(f"[+] Created chunk: {chunk_path.name}")
+        whisper = get_whisper_model(model)
 
+        def transcribe_one(i: int, audio: np.ndarray) -> str:
             try:
-                # транскрибируем
-                part_txt = transcribe_chunk(chunk_path, model, language)
-                print(f"[+] Transcribed chunk: {part_txt.name}")
+                text = transcribe_chunk(whisper, audio, language)
+            except Exception:
+                print(f"[!] Whisper failed on chunk {i}")
+                raise
+            print(f"[+] Transcribed chunk {i}")
+            return text
 
-                # дописываем в итоговый
-                with full_txt.open("a", encoding="utf-8") as out_f, part_txt.open("r", encoding="utf-8") as in_f:
-                    out_f.write(in_f.read().strip() + "\n")
-            finally:
-                # в любом случае удаляем промежуточные файлы
-                chunk_path.unlink(missing_ok=True)
-                print(f"[–] Deleted chunk file: {chunk_path.name}")
-                part_txt.unlink(missing_ok=True)
-                print(f"[–] Deleted part txt: {part_txt.name}")
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool, \
+                full_txt.open("w", encoding="utf-8", buffering=1 << 20) as out_f:
+            pending = deque()
+            try:
+                # Файл целиком в память не декодируем: куски читаются из ffmpeg по мере
+                # освобождения воркеров, готовые пишутся в итоговый строго по порядку
+                for i, audio in enumerate(iter_chunks(file_path), start=1):
+                    pending.append(pool.submit(transcribe_one, i, audio))
+                    while len(pending) > MAX_WORKERS:
+                        out_f.write(pending.popleft().result().strip())
+                        out_f.write("\n")
+                while pending:
+                    out_f.write(pending.popleft().result().strip())
+                    out_f.write("\n")
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
 
     finally:
         # убираем исходный файл
@@ -78,12 +137,12 @@ def split_and_transcribe(file_path: Path, model: str, language: str = "Russian")
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(
-        description="Split audio/video into chunks and transcribe via OpenAI Whisper."
+        description="Split audio/video into chunks and transcribe via faster-whisper."
     )
     parser.add_argument("file", type=Path, help="Path to input audio or video file.")
     parser.add_argument("model", choices=["tiny", "base", "small", "medium"],  # убрали 'turbo'
                         help="Which Whisper model to use.")
-    parser.add_argument("--lang", default="Russian", help="Language code for transcription.")
+    parser.add_argument("--lang", default="ru", help="Language code for transcription.")
     args = parser.parse_args()
 
     print(split_and_transcribe(args.file, args.model, args.lang))